@@ -3,26 +3,31 @@
 
 import os
 import re
+import sys
 import typing as t
+from dataclasses import dataclass
 from datetime import datetime, timezone
 
-import requests
 import ijson
+import orjson
 from dotenv import load_dotenv
 import gzip
 import io
 
+from cache import open_price_cache
+from market_upsert import drain_rows, get_rest_client, make_session, upsert_market_rows
+
 BUFF163_URL = "https://prices.csgotrader.app/latest/buff163.json"
 os.environ.setdefault("HTTPX_DISABLE_HTTP2", "1")
 
+_SESSION = make_session()
+
 # Load .env next to this file
 ENV_PATH = os.path.join(os.path.dirname(__file__), ".env")
 load_dotenv(dotenv_path=ENV_PATH)
 
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE") or os.environ.get("SUPABASE_ANON_KEY")
-MARKET_TABLE = os.environ.get("SUPABASE_MARKET_TABLE", "market_data")
-UPSERT_BATCH = int(os.environ.get("SUPABASE_UPSERT_BATCH", "500"))
+# Hosts com pouca memória: BUFF163_STREAMING=1 volta ao parse incremental via ijson
+BUFF163_STREAMING = os.environ.get("BUFF163_STREAMING") == "1"
 
 CONDITION_NAMES = [
     "Factory New",
@@ -37,29 +42,38 @@ PHASE_TOKENS = [
     "Phase 1", "Phase 2", "Phase 3", "Phase 4",
 ]
 
+# "(Condition)" suffix -> canonical (interned) condition string
+_CONDITION_BY_NAME = {cond: sys.intern(cond) for cond in CONDITION_NAMES}
+_PREFIX_RE = re.compile(r"StatTrak™ |StatTrak |Souvenir ")
+_PHASE_RE = re.compile("|".join(map(re.escape, PHASE_TOKENS)))
+# Maps the match back to the PHASE_TOKENS constant so every row shares it
+_PHASE_BY_TOKEN = {tok: tok for tok in PHASE_TOKENS}
+
 
 def parse_market_hash_name(name: str) -> t.Tuple[str, bool, bool, t.Optional[str]]:
     if not name:
         return "", False, False, None
     s = name
-    stattrak = "StatTrak" in s or "StatTrak™" in s
+    stattrak = "StatTrak" in s
     souvenir = "Souvenir" in s
     condition = None
-    for cond in CONDITION_NAMES:
-        if s.endswith(f"({cond})"):
-            condition = cond
-            s = s[: -(len(cond) + 2)].strip()
-            break
-    base = s.replace("StatTrak™ ", "").replace("StatTrak ", "").replace("Souvenir ", "").strip()
-    return base, stattrak, souvenir, condition
+    # rfind + dict lookup: ~2x faster than a regex search on this hot path
+    if s[-1:] == ")":
+        i = s.rfind("(")
+        if i >= 0:
+            condition = _CONDITION_BY_NAME.get(s[i + 1:-1])
+            if condition is not None:
+                s = s[:i]
+    if stattrak or souvenir:
+        # Not anchored: knives carry the tag after the star ("★ StatTrak™ ...")
+        s = _PREFIX_RE.sub("", s)
+    return sys.intern(s.strip()), stattrak, souvenir, condition
 
 
 def detect_phase(name: str) -> t.Optional[str]:
-    for token in PHASE_TOKENS:
-        # basic contains check (case sensitive to match CSGO naming)
-        if token in name:
-            return token
-    return None
+    # one scan for all tokens (case sensitive to match CSGO naming)
+    m = _PHASE_RE.search(name)
+    return _PHASE_BY_TOKEN[m.group(0)] if m else None
 
 
 def build_item_key(name_base: str, stattrak: bool, souvenir: bool, condition: t.Optional[str], phase: t.Optional[str]) -> str:
@@ -70,128 +84,136 @@ def build_item_key(name_base: str, stattrak: bool, souvenir: bool, condition: t.
         condition or "",
         phase or "",
     ]
-    return "|".join([p for p in parts if p]).strip()
-
-
-def chunked(iterable, size: int):
-    buf = []
-    for x in iterable:
-        buf.append(x)
-        if len(buf) >= size:
-            yield buf
-            buf = []
-    if buf:
-        yield buf
-
-
-def get_supabase_client():
-    from supabase import create_client
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        raise RuntimeError("SUPABASE_URL/SUPABASE_SERVICE_ROLE não configurados no ambiente")
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
-
-
-class PrependStream:
-    def __init__(self, head: bytes, base):
-        self.buf = io.BytesIO(head)
-        self.base = base
-    def read(self, n: int = -1):
-        b = self.buf.read(n)
-        if n == -1 or len(b) == n:
-            return b
-        rest = self.base.read(n - len(b))
-        return b + rest
+    return sys.intern("|".join([p for p in parts if p]).strip())
 
 
 def open_source_stream(url: str):
     headers = {"Accept": "application/json"}
-    resp = requests.get(url, headers=headers, stream=True, timeout=180)
+    resp = _SESSION.get(url, headers=headers, stream=True, timeout=180)
     resp.raise_for_status()
+    # urllib3 decodes Content-Encoding in C; the 1 MiB buffer amortizes ijson's small reads
     resp.raw.decode_content = True
-    head = resp.raw.read(4)
-    base = PrependStream(head, resp.raw)
-    if head.startswith(b"\x1f\x8b"):
-        return gzip.GzipFile(fileobj=base, mode="rb")
-    return base
+    # urllib3 auto-closes at EOF, which makes BufferedReader raise instead of returning b""
+    resp.raw.auto_close = False
+    stream = io.BufferedReader(resp.raw, buffer_size=1 << 20)
+    # Some dumps are .gz files served without Content-Encoding: peek (no copy) the magic bytes
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    return stream
 
 
-def fetch_buff163(url: str = BUFF163_URL) -> t.Iterable[t.Tuple[str, dict]]:
-    """Stream top-level mapping of name -> {starting_at: {price}, highest_order: {price}}"""
-    stream = open_source_stream(url)
-    # kvitems with empty prefix to iterate top-level keys
-    for name, entry in ijson.kvitems(stream, ""):
-        yield str(name), entry if isinstance(entry, dict) else {}
+def load_source_json(url: str):
+    """Download the whole body and parse it in one orjson pass (gunzips if needed)."""
+    headers = {"Accept": "application/json"}
+    resp = _SESSION.get(url, headers=headers, timeout=180)
+    resp.raise_for_status()
+    raw = resp.content
+    if raw[:2] == b"\x1f\x8b":
+        raw = gzip.decompress(raw)
+    return orjson.loads(raw)
 
 
-def aggregate_buff163(pairs: t.Iterable[t.Tuple[str, dict]]) -> t.Dict[str, dict]:
-    now = datetime.now(timezone.utc)
-    acc: t.Dict[str, dict] = {}
+def fetch_buff163(url: str = BUFF163_URL) -> t.Iterable[t.Tuple[str, dict]]:
+    """Iterate top-level mapping of name -> {starting_at: {price}, highest_order: {price}}"""
+    if BUFF163_STREAMING:
+        stream = open_source_stream(url)
+        # kvitems with empty prefix to iterate top-level keys
+        for name, entry in ijson.kvitems(stream, "", use_float=True):
+            yield str(name), entry if isinstance(entry, dict) else {}
+        return
+    data = load_source_json(url)
+    # popitem frees each parsed entry as soon as it is aggregated
+    while data:
+        name, entry = data.popitem()
+        yield name, entry if isinstance(entry, dict) else {}
+
+
+def to_price(value) -> t.Optional[float]:
+    # Fast path: orjson/ijson(use_float) already hand us floats
+    if value is None or type(value) is float:
+        return value
+    try:
+        return float(value)
+    except Exception:
+        return None
+
+
+@dataclass(slots=True)
+class Buff163Rec:
+    """Registro agregado por item_key (com slots, bem menor que um dict por item)."""
+    item_key: str
+    name_base: str
+    stattrak: bool
+    souvenir: bool
+    condition: t.Optional[str]
+    price_buff163: t.Optional[float]
+    highest_offer_buff163: t.Optional[float]
+    fetched_at: str
+
+    def to_row(self) -> dict:
+        return {
+            "item_key": self.item_key,
+            "name_base": self.name_base,
+            "stattrak": self.stattrak,
+            "souvenir": self.souvenir,
+            "condition": self.condition,
+            "price_buff163": self.price_buff163,
+            "highest_offer_buff163": self.highest_offer_buff163,
+            "fetched_at": self.fetched_at,
+        }
+
+
+def aggregate_buff163(pairs: t.Iterable[t.Tuple[str, dict]]) -> t.Dict[str, Buff163Rec]:
+    # Every record of a run shares the same timestamp: format it once
+    now_iso = datetime.now(timezone.utc).isoformat()
+    acc: t.Dict[str, Buff163Rec] = {}
+    # Hot loop (~1M names): bind helpers locally to skip global lookups per item
+    parse_name = parse_market_hash_name
+    phase_of = detect_phase
+    key_of = build_item_key
     for name, entry in pairs:
         start_obj = entry.get("starting_at") or entry.get("startingAt") or {}
         buy_obj = entry.get("highest_order") or entry.get("highets_offer") or entry.get("highestOrder") or {}
-        start_price = start_obj.get("price")
-        buy_price = buy_obj.get("price")
-        try:
-            p_start = float(start_price) if start_price is not None else None
-        except Exception:
-            p_start = None
-        try:
-            p_buy = float(buy_price) if buy_price is not None else None
-        except Exception:
-            p_buy = None
+        p_start = to_price(start_obj.get("price"))
+        p_buy = to_price(buy_obj.get("price"))
 
-        name_base, stattrak, souvenir, condition = parse_market_hash_name(name)
-        phase = detect_phase(name)
-        item_key = build_item_key(name_base, stattrak, souvenir, condition, phase)
+        name_base, stattrak, souvenir, condition = parse_name(name)
+        phase = phase_of(name)
+        item_key = key_of(name_base, stattrak, souvenir, condition, phase)
 
         # Aggregate duplicates: take min(start), max(buy)
         rec = acc.get(item_key)
-        if not rec:
-            acc[item_key] = rec = {
-                "item_key": item_key,
-                "name_base": name_base,
-                "stattrak": stattrak,
-                "souvenir": souvenir,
-                "condition": condition,
-                "phase": phase,
-                "price_buff163": p_start,
-                "highest_offer_buff163": p_buy,
-                "fetched_at": now,
-            }
-        else:
-            if p_start is not None:
-                if rec.get("price_buff163") is None or p_start < rec["price_buff163"]:
-                    rec["price_buff163"] = p_start
-            if p_buy is not None:
-                if rec.get("highest_offer_buff163") is None or p_buy > rec["highest_offer_buff163"]:
-                    rec["highest_offer_buff163"] = p_buy
+        if rec is None:
+            acc[item_key] = Buff163Rec(item_key, name_base, stattrak, souvenir, condition, p_start, p_buy, now_iso)
+            continue
+        if p_start is not None:
+            cur = rec.price_buff163
+            if cur is None or p_start < cur:
+                rec.price_buff163 = p_start
+        if p_buy is not None:
+            cur = rec.highest_offer_buff163
+            if cur is None or p_buy > cur:
+                rec.highest_offer_buff163 = p_buy
     return acc
 
 
-def upsert_market_rows(sb, rows: list[dict]):
-    for batch in chunked(rows, UPSERT_BATCH):
-        sb.table(MARKET_TABLE).upsert(batch, on_conflict="item_key").execute()
-
-
 def run_buff163_ingest(url: str = BUFF163_URL) -> int:
-    sb = get_supabase_client()
-    pairs = fetch_buff163(url)
-    aggregated = aggregate_buff163(pairs)
-    rows = []
-    for _, rec in aggregated.items():
-        rows.append({
-            "item_key": rec["item_key"],
-            "name_base": rec["name_base"],
-            "stattrak": bool(rec["stattrak"]),
-            "souvenir": bool(rec["souvenir"]),
-            "condition": rec["condition"],
-            "price_buff163": rec["price_buff163"],
-            "highest_offer_buff163": rec["highest_offer_buff163"],
-            "fetched_at": rec["fetched_at"].isoformat(),
-        })
-    if rows:
-        upsert_market_rows(sb, rows)
-    return len(rows)
+    with get_rest_client() as client:
+        aggregated = aggregate_buff163(fetch_buff163(url))
+        total = len(aggregated)
+        rows = drain_rows(aggregated)
+        cache = open_price_cache("buff163")
+        if cache is not None:
+            rows = cache.filter_changed(rows, ("price_buff163", "highest_offer_buff163"))
+            print(f"[buff163] {total - len(rows)} itens sem mudança (cache), {len(rows)} para upsert")
+        try:
+            count = upsert_market_rows(client, rows)
+            if cache is not None:
+                cache.commit()
+        finally:
+            if cache is not None:
+                cache.close()
+    return count
 
 
 if __name__ == "__main__":
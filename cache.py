@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cache local (SQLite) dos preços já enviados ao Supabase.
+
+Guarda, por fonte e item_key, um hash de 64 bits dos campos de preço do
+último upsert bem-sucedido. Na execução seguinte só seguem para o upsert as
+linhas cujo hash mudou. Ativado apenas quando PRICE_CACHE_PATH está definido.
+"""
+
+import os
+import sqlite3
+import struct
+import hashlib
+import typing as t
+
+_NAN = float("nan")
+# Com REFRESH_PARALLEL as fontes gravam no mesmo arquivo ao mesmo tempo: um commit
+# lento de outra fonte não pode derrubar uma execução cujo upsert já deu certo
+_LOCK_TIMEOUT = 60.0
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=_LOCK_TIMEOUT)
+    # WAL: a leitura de filter_changed não espera o commit de outra fonte
+    conn.execute("pragma journal_mode=wal")
+    return conn
+
+
+def price_hash(*values) -> int:
+    # None vira NaN para não colidir com preço 0
+    packed = struct.pack(f"<{len(values)}d", *[_NAN if v is None else v for v in values])
+    return int.from_bytes(hashlib.blake2b(packed, digest_size=8).digest(), "little", signed=True)
+
+
+class PriceCache:
+    def __init__(self, path: str, source: str):
+        self.source = source
+        self.conn = _connect(path)
+        self.conn.execute(
+            "create table if not exists price_cache ("
+            " source text not null, item_key text not null, h integer not null,"
+            " primary key (source, item_key)) without rowid"
+        )
+        self._pending: t.List[t.Tuple[str, str, int]] = []
+
+    def filter_changed(self, rows: t.Iterable[dict], fields: t.Sequence[str]) -> t.List[dict]:
+        """Retorna só as linhas cujo hash de `fields` difere do último upsert."""
+        known = dict(self.conn.execute("select item_key, h from price_cache where source = ?", (self.source,)))
+        source = self.source
+        pending = []
+        changed = []
+        for row in rows:
+            key = row["item_key"]
+            h = price_hash(*[row[f] for f in fields])
+            if known.get(key) != h:
+                changed.append(row)
+                pending.append((source, key, h))
+        self._pending = pending
+        return changed
+
+    def commit(self):
+        """Grava os hashes pendentes; chamar só depois do upsert bem-sucedido."""
+        with self.conn:
+            self.conn.executemany(
+                "insert into price_cache (source, item_key, h) values (?, ?, ?)"
+                " on conflict (source, item_key) do update set h = excluded.h",
+                self._pending,
+            )
+        self._pending = []
+
+    def close(self):
+        self.conn.close()
+
+
+def cache_path() -> t.Optional[str]:
+    # Lido sob demanda: os fetchers carregam o .env depois dos imports
+    return os.environ.get("PRICE_CACHE_PATH") or None
+
+
+def open_price_cache(source: str) -> t.Optional[PriceCache]:
+    path = cache_path()
+    if not path:
+        return None
+    return PriceCache(path, source)
+
+
+def clear_price_cache():
+    """Esquece todos os hashes (a tabela remota foi limpa e precisa ser recarregada)."""
+    path = cache_path()
+    if not path or not os.path.exists(path):
+        return
+    conn = _connect(path)
+    try:
+        with conn:
+            conn.execute("drop table if exists price_cache")
+    finally:
+        conn.close()
@@ -2,24 +2,30 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import sys
 import typing as t
+from dataclasses import dataclass
 from datetime import datetime, timezone
 
-import requests
 from dotenv import load_dotenv
 import ijson
+import orjson
+
+from cache import open_price_cache
+from market_upsert import drain_rows, get_rest_client, make_session, upsert_market_rows
 
 CSFLOAT_URL = "https://csfloat.com/api/v1/listings/price-list"
 os.environ.setdefault("HTTPX_DISABLE_HTTP2", "1")
 
+_SESSION = make_session()
+
 # Load .env beside this file
 ENV_PATH = os.path.join(os.path.dirname(__file__), ".env")
 load_dotenv(dotenv_path=ENV_PATH)
 
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE") or os.environ.get("SUPABASE_ANON_KEY")
-MARKET_TABLE = os.environ.get("SUPABASE_MARKET_TABLE", "market_data")
-UPSERT_BATCH = int(os.environ.get("SUPABASE_UPSERT_BATCH", "500"))
+# Hosts com pouca memória: CSFLOAT_STREAMING=1 volta ao parse incremental via ijson
+CSFLOAT_STREAMING = os.environ.get("CSFLOAT_STREAMING") == "1"
 
 CONDITION_NAMES = [
     "Factory New",
@@ -29,21 +35,29 @@ CONDITION_NAMES = [
     "Battle-Scarred",
 ]
 
+# "(Condition)" suffix -> canonical (interned) condition string
+_CONDITION_BY_NAME = {cond: sys.intern(cond) for cond in CONDITION_NAMES}
+_PREFIX_RE = re.compile(r"StatTrak™ |StatTrak |Souvenir ")
+
 
 def parse_market_hash_name(name: str) -> t.Tuple[str, bool, bool, t.Optional[str]]:
     if not name:
         return "", False, False, None
     s = name
-    stattrak = "StatTrak" in s or "StatTrak™" in s
+    stattrak = "StatTrak" in s
     souvenir = "Souvenir" in s
     condition = None
-    for cond in CONDITION_NAMES:
-        if s.endswith(f"({cond})"):
-            condition = cond
-            s = s[: -(len(cond) + 2)].strip()
-            break
-    base = s.replace("StatTrak™ ", "").replace("StatTrak ", "").replace("Souvenir ", "").strip()
-    return base, stattrak, souvenir, condition
+    # rfind + dict lookup: ~2x faster than a regex search on this hot path
+    if s[-1:] == ")":
+        i = s.rfind("(")
+        if i >= 0:
+            condition = _CONDITION_BY_NAME.get(s[i + 1:-1])
+            if condition is not None:
+                s = s[:i]
+    if stattrak or souvenir:
+        # Not anchored: knives carry the tag after the star ("★ StatTrak™ ...")
+        s = _PREFIX_RE.sub("", s)
+    return sys.intern(s.strip()), stattrak, souvenir, condition
 
 
 def build_item_key(name_base: str, stattrak: bool, souvenir: bool, condition: t.Optional[str], phase: t.Optional[str]) -> str:
@@ -54,61 +68,69 @@ def build_item_key(name_base: str, stattrak: bool, souvenir: bool, condition: t.
         condition or "",
         phase or "",
     ]
-    return "|".join([p for p in parts if p != ""]).strip()
-
-
-def chunked(iterable, size: int):
-    buf = []
-    for x in iterable:
-        buf.append(x)
-        if len(buf) >= size:
-            yield buf
-            buf = []
-    if buf:
-        yield buf
-
-
-def get_supabase_client():
-    from supabase import create_client
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        raise RuntimeError("SUPABASE_URL/SUPABASE_SERVICE_ROLE não configurados no ambiente")
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
+    return sys.intern("|".join([p for p in parts if p != ""]).strip())
 
 
 import gzip
 import io
 
 
-class PrependStream:
-    def __init__(self, head: bytes, base):
-        self.buf = io.BytesIO(head)
-        self.base = base
-
-    def read(self, n: int = -1):
-        b = self.buf.read(n)
-        if n == -1 or len(b) == n:
-            return b
-        rest = self.base.read(n - len(b))
-        return b + rest
-
-
 def open_source_stream(url: str):
     headers = {"Accept": "application/json"}
-    resp = requests.get(url, headers=headers, stream=True, timeout=180)
+    resp = _SESSION.get(url, headers=headers, stream=True, timeout=180)
     resp.raise_for_status()
+    # urllib3 decodes Content-Encoding in C; the 1 MiB buffer amortizes ijson's small reads
     resp.raw.decode_content = True
-    head = resp.raw.read(4)
-    base = PrependStream(head, resp.raw)
-    if head.startswith(b"\x1f\x8b"):
-        return gzip.GzipFile(fileobj=base, mode="rb")
-    return base
+    # urllib3 auto-closes at EOF, which makes BufferedReader raise instead of returning b""
+    resp.raw.auto_close = False
+    stream = io.BufferedReader(resp.raw, buffer_size=1 << 20)
+    # Some dumps are .gz files served without Content-Encoding: peek (no copy) the magic bytes
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    return stream
+
+
+def load_source_bytes(url: str) -> bytes:
+    """Download the whole body (gunzips if needed) for a single orjson pass."""
+    headers = {"Accept": "application/json"}
+    resp = _SESSION.get(url, headers=headers, timeout=180)
+    resp.raise_for_status()
+    raw = resp.content
+    if raw[:2] == b"\x1f\x8b":
+        raw = gzip.decompress(raw)
+    return raw
 
 
 def fetch_csfloat(url: str = CSFLOAT_URL) -> t.Iterable[dict]:
+    if CSFLOAT_STREAMING:
+        yield from stream_csfloat(url)
+        return
+    raw = load_source_bytes(url)
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # Fallback: NDJSON per line, reusing the bytes already downloaded
+        for line in raw.splitlines():
+            try:
+                obj = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            if isinstance(obj, dict):
+                yield obj
+        return
+    if isinstance(data, list):
+        # Reversed pops free each parsed item as soon as it is aggregated
+        while data:
+            obj = data.pop()
+            if isinstance(obj, dict):
+                yield obj
+
+
+def stream_csfloat(url: str = CSFLOAT_URL) -> t.Iterable[dict]:
     # Try stream as JSON array
     stream = open_source_stream(url)
     try:
-        for obj in ijson.items(stream, "item"):
+        for obj in ijson.items(stream, "item", use_float=True):
             if isinstance(obj, dict):
                 yield obj
         return
@@ -118,81 +140,98 @@ def fetch_csfloat(url: str = CSFLOAT_URL) -> t.Iterable[dict]:
     stream = open_source_stream(url)
     for line in stream:
         try:
-            import json
-            obj = json.loads(line)
+            obj = orjson.loads(line)
             if isinstance(obj, dict):
                 yield obj
         except Exception:
             continue
 
 
-def aggregate_csfloat(items: t.Iterable[dict]) -> t.Dict[str, dict]:
-    now = datetime.now(timezone.utc)
-    acc: t.Dict[str, dict] = {}
+def to_price(value) -> t.Optional[float]:
+    # csfloat min_price pode vir em cents: inteiros são convertidos para USD
+    if value is None or type(value) is float:
+        return value
+    try:
+        if isinstance(value, int):
+            return float(value) / 100.0
+        return float(value)
+    except Exception:
+        return None
+
+
+@dataclass(slots=True)
+class CsfloatRec:
+    """Registro agregado por item_key (com slots, bem menor que um dict por item)."""
+    item_key: str
+    name_base: str
+    stattrak: bool
+    souvenir: bool
+    condition: t.Optional[str]
+    price_csfloat: t.Optional[float]
+    qty_csfloat: int
+    fetched_at: str
+
+    def to_row(self) -> dict:
+        return {
+            "item_key": self.item_key,
+            "name_base": self.name_base,
+            "stattrak": self.stattrak,
+            "souvenir": self.souvenir,
+            "condition": self.condition,
+            "price_csfloat": self.price_csfloat,
+            "qty_csfloat": self.qty_csfloat,
+            "fetched_at": self.fetched_at,
+        }
+
+
+def aggregate_csfloat(items: t.Iterable[dict]) -> t.Dict[str, CsfloatRec]:
+    # Every record of a run shares the same timestamp: format it once
+    now_iso = datetime.now(timezone.utc).isoformat()
+    acc: t.Dict[str, CsfloatRec] = {}
+    # Hot loop: bind helpers locally to skip global lookups per item
+    parse_name = parse_market_hash_name
+    key_of = build_item_key
     for it in items:
         name = it.get("market_hash_name") or ""
         qty = it.get("qty") or 0
-        min_price = it.get("min_price")
-        try:
-            qty = int(qty)
-        except Exception:
-            qty = 0
-        try:
-            # csfloat min_price pode vir em cents. Se for inteiro grande, converte para USD
-            if isinstance(min_price, (int,)):
-                price = float(min_price) / 100.0
-            else:
-                price = float(min_price) if min_price is not None else None
-        except Exception:
-            price = None
-        name_base, stattrak, souvenir, condition = parse_market_hash_name(str(name))
-        item_key = build_item_key(name_base, stattrak, souvenir, condition, None)
+        if type(qty) is not int:
+            try:
+                qty = int(qty)
+            except Exception:
+                qty = 0
+        price = to_price(it.get("min_price"))
+        name_base, stattrak, souvenir, condition = parse_name(name if type(name) is str else str(name))
+        item_key = key_of(name_base, stattrak, souvenir, condition, None)
         rec = acc.get(item_key)
-        if not rec:
-            acc[item_key] = rec = {
-                "item_key": item_key,
-                "name_base": name_base,
-                "stattrak": stattrak,
-                "souvenir": souvenir,
-                "condition": condition,
-                "phase": None,
-                "price_csfloat": price,
-                "qty_csfloat": qty,
-                "fetched_at": now,
-            }
-        else:
-            # Aggregate duplicates: sum qty, keep min price
-            rec["qty_csfloat"] = int(rec.get("qty_csfloat", 0)) + qty
-            if price is not None:
-                if rec.get("price_csfloat") is None or price < rec["price_csfloat"]:
-                    rec["price_csfloat"] = price
+        if rec is None:
+            acc[item_key] = CsfloatRec(item_key, name_base, stattrak, souvenir, condition, price, qty, now_iso)
+            continue
+        # Aggregate duplicates: sum qty, keep min price
+        rec.qty_csfloat += qty
+        if price is not None:
+            cur = rec.price_csfloat
+            if cur is None or price < cur:
+                rec.price_csfloat = price
     return acc
 
 
-def upsert_market_rows(sb, rows: list[dict]):
-    for batch in chunked(rows, UPSERT_BATCH):
-        sb.table(MARKET_TABLE).upsert(batch, on_conflict="item_key").execute()
-
-
 def run_csfloat_ingest(url: str = CSFLOAT_URL) -> int:
-    sb = get_supabase_client()
-    items = fetch_csfloat(url)
-    aggregated = aggregate_csfloat(items)
-    rows = []
-    for _, rec in aggregated.items():
-        rows.append({
-            "item_key": rec["item_key"],
-            "name_base": rec["name_base"],
-            "stattrak": bool(rec["stattrak"]),
-            "souvenir": bool(rec["souvenir"]),
-            "condition": rec["condition"],
-            "price_csfloat": rec["price_csfloat"],
-            "qty_csfloat": int(rec["qty_csfloat"]),
-            "fetched_at": rec["fetched_at"].isoformat(),
-        })
-    if rows:
-        upsert_market_rows(sb, rows)
-    return len(rows)
+    with get_rest_client() as client:
+        aggregated = aggregate_csfloat(fetch_csfloat(url))
+        total = len(aggregated)
+        rows = drain_rows(aggregated)
+        cache = open_price_cache("csfloat")
+        if cache is not None:
+            rows = cache.filter_changed(rows, ("price_csfloat", "qty_csfloat"))
+            print(f"[csfloat] {total - len(rows)} itens sem mudança (cache), {len(rows)} para upsert")
+        try:
+            count = upsert_market_rows(client, rows)
+            if cache is not None:
+                cache.commit()
+        finally:
+            if cache is not None:
+                cache.close()
+    return count
 
 
 if __name__ == "__main__":
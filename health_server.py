@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
-from flask import Flask, jsonify
-app = Flask(__name__)
-@app.get(/health)
-def health():
-    return jsonify({"status": "ok"})
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BODY = b'{"status": "ok"}'
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/health":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format, *args):
+        # healthchecks a cada poucos segundos: não poluir o log
+        pass
+
+
 if __name__ == "__main__":
-    import os
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8080)))
+    ThreadingHTTPServer(("0.0.0.0", int(os.getenv("PORT", 8080))), HealthHandler).serve_forever()
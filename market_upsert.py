@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Escrita na tabela unificada (SUPABASE_MARKET_TABLE) compartilhada pelos fetchers.
+
+Cliente PostgREST, sessão HTTP com keep-alive para os downloads e o upsert
+em lotes concorrentes (ou numa única chamada a bulk_upsert_market).
+"""
+
+import os
+import threading
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from operator import itemgetter
+
+import httpx
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+# Os fetchers importam este módulo antes de ler o ambiente: carrega o .env aqui também
+ENV_PATH = os.path.join(os.path.dirname(__file__), ".env")
+load_dotenv(dotenv_path=ENV_PATH)
+
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE") or os.environ.get("SUPABASE_ANON_KEY")
+MARKET_TABLE = os.environ.get("SUPABASE_MARKET_TABLE", "market_data")
+UPSERT_BATCH = int(os.environ.get("SUPABASE_UPSERT_BATCH", "5000"))
+# PostgREST recusa corpos grandes: lotes acima deste tamanho são divididos ao meio
+UPSERT_MAX_BYTES = int(os.environ.get("SUPABASE_UPSERT_MAX_BYTES", str(4 * 1024 * 1024)))
+# Lotes enviados em paralelo (escrita é limitada por RTT, não por CPU)
+UPSERT_WORKERS = int(os.environ.get("SUPABASE_UPSERT_WORKERS", "8"))
+# SUPABASE_UPSERT_RPC=1: grava tudo numa única transação via bulk_upsert_market (migration 005)
+UPSERT_RPC = os.environ.get("SUPABASE_UPSERT_RPC") == "1"
+
+
+def make_session() -> requests.Session:
+    """Sessão com keep-alive para os downloads: evita um handshake TCP+TLS por request (e por retry)."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=3))
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
+
+
+def get_rest_client() -> httpx.Client:
+    """PostgREST client used for bulk upserts (skips supabase-py's request building)."""
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise RuntimeError("SUPABASE_URL/SUPABASE_SERVICE_ROLE não configurados no ambiente")
+    headers = {
+        "apikey": SUPABASE_KEY,
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "Content-Type": "application/json",
+    }
+    return httpx.Client(base_url=f"{SUPABASE_URL}/rest/v1", headers=headers, timeout=120)
+
+
+def chunked(iterable, size: int):
+    if isinstance(iterable, list):
+        # Flushes hand over a ready list: one slice per batch, no per-item bookkeeping
+        for i in range(0, len(iterable), size):
+            yield iterable[i:i + size]
+        return
+    it = iter(iterable)
+    while True:
+        # islice fills each batch in C instead of an append + len check per item
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+_item_key_of = itemgetter("item_key")
+
+
+def post_market_batch(client: httpx.Client, batch: list[dict]):
+    # Same lock order in every writer: concurrent sources upserting shared rows cannot deadlock
+    batch.sort(key=_item_key_of)
+    body = orjson.dumps(batch)
+    if len(body) > UPSERT_MAX_BYTES and len(batch) > 1:
+        mid = len(batch) // 2
+        post_market_batch(client, batch[:mid])
+        post_market_batch(client, batch[mid:])
+        return
+    resp = client.post(
+        f"/{MARKET_TABLE}",
+        params={"on_conflict": "item_key"},
+        headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+        content=body,
+    )
+    resp.raise_for_status()
+
+
+def upsert_market_rows(client: httpx.Client, rows: t.Iterable[dict]) -> int:
+    """Upsert rows (any iterable, consumed lazily) and return how many were sent."""
+    # bulk_upsert_market writes public.market_data only; other tables take the PostgREST path
+    if UPSERT_RPC and MARKET_TABLE == "market_data":
+        rows = sorted(rows, key=_item_key_of)
+        if not rows:
+            # Caso comum com o cache de preços: nada mudou, nada a enviar
+            return 0
+        body = orjson.dumps({"p": rows})
+        # Falls back to batching when the whole run does not fit in one request body
+        if len(body) <= UPSERT_MAX_BYTES:
+            resp = client.post("/rpc/bulk_upsert_market", content=body)
+            resp.raise_for_status()
+            return len(rows)
+        del body
+    workers = max(1, UPSERT_WORKERS)
+    # Caps batches built but not yet sent, so `rows` is pulled only as fast as Supabase drains it
+    inflight = threading.BoundedSemaphore(workers * 2)
+    futures = []
+    sent = 0
+    # httpx.Client is thread-safe; the pool size bounds concurrent writes on Postgres
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for batch in chunked(rows, UPSERT_BATCH):
+            inflight.acquire()
+            fut = ex.submit(post_market_batch, client, batch)
+            fut.add_done_callback(lambda _: inflight.release())
+            futures.append(fut)
+            sent += len(batch)
+    for fut in futures:
+        # re-raises the first failed batch
+        fut.result()
+    return sent
+
+
+def drain_rows(aggregated: dict, ordered: bool = False) -> t.Iterator[dict]:
+    """Esvazia o agregado (item_key -> registro com to_row()) já no formato de upsert.
+
+    Cada registro vira linha ao sair do dict: registros e linhas nunca ficam todos
+    residentes. ordered=True sai em ordem de item_key, e cada lote concorrente cobre
+    a sua própria faixa contígua de chaves.
+    """
+    if ordered:
+        for key in sorted(aggregated):
+            yield aggregated.pop(key).to_row()
+        return
+    while aggregated:
+        yield aggregated.popitem()[1].to_row()
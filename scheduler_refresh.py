@@ -4,7 +4,9 @@
 import os
 import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 
 from dotenv import load_dotenv
 
@@ -16,6 +18,8 @@ SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE") or os.environ.get("SUPABASE_ANON_KEY")
 MARKET_TABLE = os.environ.get("SUPABASE_MARKET_TABLE", "market_data")
 INTERVAL_SECONDS = int(os.environ.get("REFRESH_INTERVAL_SECONDS", str(3 * 60 * 60)))  # 3h default
+# REFRESH_PARALLEL=0 volta à execução sequencial (menor pico de memória)
+PARALLEL_SOURCES = os.environ.get("REFRESH_PARALLEL", "1") != "0"
 
 os.environ.setdefault("HTTPX_DISABLE_HTTP2", "1")
 
@@ -28,8 +32,20 @@ def get_sb():
 
 def clean_market_table(sb):
     print("[clean] Apagando dados antigos de", MARKET_TABLE)
-    # Remoção ampla – evita WHERE vazio proibido
-    sb.table(MARKET_TABLE).delete().neq("item_key", "__never__").execute()
+    truncated = False
+    if MARKET_TABLE == "market_data":
+        # TRUNCATE via função SECURITY DEFINER (migration 006)
+        try:
+            sb.rpc("truncate_market").execute()
+            truncated = True
+        except Exception as e:
+            print(f"[clean] truncate_market indisponível ({e}); usando DELETE")
+    if not truncated:
+        # Remoção ampla – evita WHERE vazio proibido
+        sb.table(MARKET_TABLE).delete().neq("item_key", "__never__").execute()
+    # Sem isso o cache local pularia o recarregamento de itens com preço inalterado
+    from cache import clear_price_cache
+    clear_price_cache()
 
 
 def refresh_sources():
@@ -38,13 +54,26 @@ def refresh_sources():
     import csfloat_fetcher as cf
     import buff163_fetcher as bf
 
+    sources = [
+        # gc.disable() do WhiteMarket é global ao processo: só pausa o GC rodando sozinho
+        ("Whitemarket", partial(wm.run_whitemarket_ingest, pause_gc=not PARALLEL_SOURCES)),
+        ("CSFloat", cf.run_csfloat_ingest),
+        ("Buff163", bf.run_buff163_ingest),
+    ]
     total = 0
-    print("[run] Whitemarket...")
-    total += wm.run_whitemarket_ingest()
-    print("[run] CSFloat...")
-    total += cf.run_csfloat_ingest()
-    print("[run] Buff163...")
-    total += bf.run_buff163_ingest()
+    if not PARALLEL_SOURCES:
+        for label, run in sources:
+            print(f"[run] {label}...")
+            total += run()
+        print(f"[run] Total upserts: {total}")
+        return total
+
+    # As três fontes passam a maior parte do tempo esperando HTTP: rodam em paralelo
+    print("[run] " + ", ".join(label for label, _ in sources) + " (em paralelo)...")
+    with ThreadPoolExecutor(max_workers=len(sources)) as ex:
+        futures = [ex.submit(run) for _, run in sources]
+    for fut in futures:
+        total += fut.result()
     print(f"[run] Total upserts: {total}")
     return total
 
@@ -0,0 +1,53 @@
+-- Upsert em massa numa única transação (um INSERT ... ON CONFLICT por chamada)
+-- Cada fonte envia apenas as suas colunas: colunas ausentes no payload preservam o valor atual
+
+create or replace function public.bulk_upsert_market(p jsonb)
+returns integer
+language plpgsql
+security definer
+as $$
+declare
+  keys  text[];
+  n     integer;
+begin
+  if p is null or jsonb_array_length(p) = 0 then
+    return 0;
+  end if;
+  -- Todas as linhas de um lote vêm da mesma fonte e têm as mesmas chaves
+  select array_agg(k) into keys from jsonb_object_keys(p->0) as k;
+
+  insert into public.market_data as md (
+    item_key, name_base, stattrak, souvenir, condition,
+    price_buff163, highest_offer_buff163,
+    price_csfloat, qty_csfloat,
+    price_whitemarket, qty_whitemarket,
+    fetched_at
+  )
+  select
+    r.item_key, r.name_base, r.stattrak, r.souvenir, r.condition,
+    r.price_buff163, r.highest_offer_buff163,
+    r.price_csfloat, r.qty_csfloat,
+    r.price_whitemarket, r.qty_whitemarket,
+    r.fetched_at
+  from jsonb_populate_recordset(null::public.market_data, p) as r
+  on conflict (item_key) do update set
+    name_base             = excluded.name_base,
+    stattrak              = excluded.stattrak,
+    souvenir              = excluded.souvenir,
+    condition             = excluded.condition,
+    price_buff163         = case when 'price_buff163' = any(keys) then excluded.price_buff163 else md.price_buff163 end,
+    highest_offer_buff163 = case when 'highest_offer_buff163' = any(keys) then excluded.highest_offer_buff163 else md.highest_offer_buff163 end,
+    price_csfloat         = case when 'price_csfloat' = any(keys) then excluded.price_csfloat else md.price_csfloat end,
+    qty_csfloat           = case when 'qty_csfloat' = any(keys) then excluded.qty_csfloat else md.qty_csfloat end,
+    price_whitemarket     = case when 'price_whitemarket' = any(keys) then excluded.price_whitemarket else md.price_whitemarket end,
+    qty_whitemarket       = case when 'qty_whitemarket' = any(keys) then excluded.qty_whitemarket else md.qty_whitemarket end,
+    fetched_at            = excluded.fetched_at;
+
+  get diagnostics n = row_count;
+  return n;
+end;
+$$;
+
+revoke all on function public.bulk_upsert_market(jsonb) from public;
+grant execute on function public.bulk_upsert_market(jsonb) to service_role;
+
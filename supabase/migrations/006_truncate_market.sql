@@ -0,0 +1,14 @@
+-- Limpeza total da tabela unificada (usada por scheduler_refresh.py --clean)
+-- TRUNCATE é O(1): não gera uma tupla morta por linha nem dívida de VACUUM como o DELETE
+
+create or replace function public.truncate_market()
+returns void
+language sql
+security definer
+as $$
+  truncate table public.market_data restart identity;
+$$;
+
+revoke all on function public.truncate_market() from public;
+grant execute on function public.truncate_market() to service_role;
+
@@ -0,0 +1,91 @@
+import pytest
+
+import buff163_fetcher
+import cache
+import scheduler_refresh
+
+FIELDS = ("price_buff163", "highest_offer_buff163")
+
+
+def make_rows(n=3, price=1.5):
+    return [
+        {"item_key": f"AK-47 | Redline|Field-Tested {i}", "price_buff163": price, "highest_offer_buff163": None}
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def cache_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "price_cache.sqlite")
+    monkeypatch.setenv("PRICE_CACHE_PATH", path)
+    return path
+
+
+def test_unchanged_second_run_sends_nothing(cache_path):
+    first = cache.open_price_cache("buff163")
+    assert len(first.filter_changed(make_rows(), FIELDS)) == 3
+    first.commit()
+    first.close()
+
+    second = cache.open_price_cache("buff163")
+    assert second.filter_changed(make_rows(), FIELDS) == []
+    # a changed price is sent again
+    rows = make_rows()
+    rows[1]["price_buff163"] = 2.0
+    assert [r["item_key"] for r in second.filter_changed(rows, FIELDS)] == [rows[1]["item_key"]]
+    second.close()
+
+
+def test_none_and_zero_hash_differently(cache_path):
+    assert cache.price_hash(None) != cache.price_hash(0.0)
+    c = cache.open_price_cache("buff163")
+    c.filter_changed(make_rows(price=None), FIELDS)
+    c.commit()
+    assert len(c.filter_changed(make_rows(price=0.0), FIELDS)) == 3
+    c.close()
+
+
+def test_failed_upsert_commits_nothing(cache_path, monkeypatch):
+    class Client:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    def failing_upsert(client, rows):
+        raise RuntimeError("upsert failed")
+
+    pairs = [(f"AK-47 | Redline (Field-Tested) {i}", {"starting_at": {"price": 1.5}}) for i in range(3)]
+    monkeypatch.setattr(buff163_fetcher, "fetch_buff163", lambda url: iter(pairs))
+    monkeypatch.setattr(buff163_fetcher, "get_rest_client", Client)
+    monkeypatch.setattr(buff163_fetcher, "upsert_market_rows", failing_upsert)
+    with pytest.raises(RuntimeError):
+        buff163_fetcher.run_buff163_ingest()
+
+    c = cache.open_price_cache("buff163")
+    assert c.conn.execute("select count(*) from price_cache").fetchone()[0] == 0
+    c.close()
+
+
+def test_clean_clears_cache(cache_path, monkeypatch):
+    monkeypatch.setattr(scheduler_refresh, "MARKET_TABLE", "market_data")
+
+    class Sb:
+        def rpc(self, name):
+            assert name == "truncate_market"
+            return self
+
+        def execute(self):
+            return None
+
+    c = cache.open_price_cache("buff163")
+    c.filter_changed(make_rows(), FIELDS)
+    c.commit()
+    c.close()
+
+    scheduler_refresh.clean_market_table(Sb())
+
+    c = cache.open_price_cache("buff163")
+    assert len(c.filter_changed(make_rows(), FIELDS)) == 3
+    c.close()
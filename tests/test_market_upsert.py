@@ -0,0 +1,39 @@
+import pytest
+
+import market_upsert
+
+
+class RecordingClient:
+    def __init__(self):
+        self.posts = []
+
+    def post(self, path, **kwargs):
+        self.posts.append(path)
+        return self
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.mark.parametrize("rpc", [False, True])
+def test_empty_rows_post_nothing(monkeypatch, rpc):
+    monkeypatch.setattr(market_upsert, "UPSERT_RPC", rpc)
+    monkeypatch.setattr(market_upsert, "MARKET_TABLE", "market_data")
+    client = RecordingClient()
+    assert market_upsert.upsert_market_rows(client, iter([])) == 0
+    assert client.posts == []
+
+
+def test_rpc_only_for_market_data(monkeypatch):
+    monkeypatch.setattr(market_upsert, "UPSERT_RPC", True)
+    rows = [{"item_key": "b"}, {"item_key": "a"}]
+
+    monkeypatch.setattr(market_upsert, "MARKET_TABLE", "market_data")
+    client = RecordingClient()
+    assert market_upsert.upsert_market_rows(client, list(rows)) == 2
+    assert client.posts == ["/rpc/bulk_upsert_market"]
+
+    monkeypatch.setattr(market_upsert, "MARKET_TABLE", "market_data_staging")
+    client = RecordingClient()
+    assert market_upsert.upsert_market_rows(client, list(rows)) == 2
+    assert client.posts == ["/market_data_staging"]
@@ -0,0 +1,51 @@
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import orjson
+import pytest
+
+import buff163_fetcher
+import csfloat_fetcher
+import whitemarket_fetcher
+
+PAYLOAD = orjson.dumps({f"AK-47 | Redline (Field-Tested) #{i}": {"price": i / 100} for i in range(30000)})
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body, headers = PAYLOAD, {}
+        if self.path.endswith(".gz"):
+            body = gzip.compress(PAYLOAD)
+        elif self.path == "/encoded":
+            body = gzip.compress(PAYLOAD)
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def base_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("module", [buff163_fetcher, csfloat_fetcher, whitemarket_fetcher])
+@pytest.mark.parametrize("path", ["/plain", "/dump.json.gz", "/encoded"])
+def test_open_source_stream_reads_to_eof(base_url, module, path):
+    stream = module.open_source_stream(base_url + path)
+    # read() past EOF must return b"" instead of raising on the auto-closed response
+    assert stream.read() == PAYLOAD
+    assert stream.read() == b""
@@ -2,215 +2,54 @@
 # -*- coding: utf-8 -*-
 
 """
-WhiteMarket (CSV) fast ingestor
+WhiteMarket ingestor
 
-Lê o CSV leve de preços do WhiteMarket (prices/730.csv) que já traz:
-- market_hash_name (nome do item)
-- price (menor preço anunciado)
-- market_product_count (total de anúncios)
-
-Normaliza por (name_base, is_stattrak, is_souvenir, condition) e faz upsert
-na tabela SUPABASE_MARKET_TABLE (default: market_data), mantendo o MENOR
-preço por variante e somando qty.
+Lê o CSV leve de preços do WhiteMarket (prices/730.csv) — ou, com
+prefer_csv=False, o JSON de produtos — normaliza por (name_base,
+is_stattrak, is_souvenir, condition) e faz upsert na tabela
+SUPABASE_MARKET_TABLE (default: market_data), mantendo o MENOR preço por
+variante e somando qty.
 """
 
 import os
-import io
-import csv
-from datetime import datetime, timezone
-import typing as t
-
-import requests
-
-# URLs de fonte
-WHITEMARKET_PRICES_CSV = os.environ.get(
-    "WHITEMARKET_PRICES_CSV",
-    "https://s3.white.market/export/v1/prices/730.csv",
-)
-
-# Supabase
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE") or os.environ.get("SUPABASE_SERVICE_KEY") or os.environ.get("SUPABASE_ANON_KEY")
-MARKET_TABLE = os.environ.get("SUPABASE_MARKET_TABLE", "market_data")
-UPSERT_BATCH = int(os.environ.get("SUPABASE_UPSERT_BATCH", "500"))
-
-
-def get_supabase_client():
-    from supabase import create_client
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        raise RuntimeError("SUPABASE_URL/SUPABASE_SERVICE_ROLE não configurados no ambiente")
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
-
-
-def chunked(iterable, size: int):
-    buf = []
-    for x in iterable:
-        buf.append(x)
-        if len(buf) >= size:
-            yield buf
-            buf = []
-    if buf:
-        yield buf
-
-
-CONDITION_NAMES = [
-    "Factory New",
-    "Minimal Wear",
-    "Field-Tested",
-    "Well-Worn",
-    "Battle-Scarred",
-]
-
-
-def parse_market_hash_name(name: str) -> t.Tuple[str, bool, bool, t.Optional[str]]:
-    if not name:
-        return "", False, False, None
-    s = str(name)
-    stattrak = ("StatTrak™" in s) or ("StatTrak" in s)
-    souvenir = ("Souvenir" in s)
-    condition = None
-    for cond in CONDITION_NAMES:
-        suffix = f"({cond})"
-        if s.endswith(suffix):
-            condition = cond
-            s = s[: -len(suffix)].strip()
-            break
-    base = s.replace("StatTrak™ ", "").replace("StatTrak ", "").replace("Souvenir ", "").strip()
-    return base, stattrak, souvenir, condition
-
-
-def build_item_key(name_base: str, stattrak: bool, souvenir: bool, condition: t.Optional[str]) -> str:
-    parts = [
-        name_base or "",
-        ("StatTrak" if stattrak else ""),
-        ("Souvenir" if souvenir else ""),
-        condition or "",
-    ]
-    return "|".join([p for p in parts if p != ""]).strip()
-
-
-def iter_prices_csv(url: str = WHITEMARKET_PRICES_CSV) -> t.Iterable[dict]:
-    headers = {"Accept": "text/csv"}
-    api_token = os.environ.get("WHITEMARKET_API_TOKEN")
-    if api_token:
-        headers["Authorization"] = f"Bearer {api_token}"
-    with requests.get(url, headers=headers, stream=True, timeout=180) as resp:
-        resp.raise_for_status()
-        text_stream = io.TextIOWrapper(resp.raw, encoding="utf-8", errors="ignore")
-        reader = csv.DictReader(text_stream)
-        for row in reader:
-            yield {
-                "market_hash_name": (row.get("market_hash_name") or "").strip(),
-                "price": (row.get("price") or "").strip(),
-                "market_product_count": (row.get("market_product_count") or "").strip(),
-            }
-
-
-def upsert_market_rows(sb, rows: list[dict]):
-    for batch in chunked(rows, UPSERT_BATCH):
-        sb.table(MARKET_TABLE).upsert(batch, on_conflict="item_key").execute()
-
-
-def run_whitemarket_ingest() -> int:
-    print("[whitemarket] Iniciando ingest CSV de preços")
-    sb = get_supabase_client()
-    aggregated: dict[str, dict] = {}
-    raw_count = 0
-
-    try:
-        for row in iter_prices_csv(WHITEMARKET_PRICES_CSV):
-            name = row["market_hash_name"]
-            if not name:
-                continue
-            price_str = row["price"]
-            count_str = row["market_product_count"]
-            try:
-                price = float(price_str.replace(",", ".")) if price_str else None
-            except Exception:
-                price = None
-            try:
-                qty = int(count_str) if count_str and count_str.isdigit() else 0
-            except Exception:
-                qty = 0
-            if price is None or price <= 0:
-                continue
-
-            name_base, stattrak, souvenir, condition = parse_market_hash_name(name)
-            if not name_base:
-                continue
-            item_key = build_item_key(name_base, stattrak, souvenir, condition)
-
-            rec = aggregated.get(item_key)
-            if rec is None:
-                aggregated[item_key] = {
-                    "item_key": item_key,
-                    "name_base": name_base,
-                    "stattrak": bool(stattrak),
-                    "souvenir": bool(souvenir),
-                    "condition": condition,
-                    "price_whitemarket": float(price),
-                    "qty_whitemarket": int(qty),
-                    "fetched_at": datetime.now(timezone.utc).isoformat(),
-                }
-            else:
-                try:
-                    cur = float(rec.get("price_whitemarket"))
-                except Exception:
-                    cur = None
-                if cur is None or price < cur:
-                    rec["price_whitemarket"] = float(price)
-                rec["qty_whitemarket"] = int(rec.get("qty_whitemarket", 0)) + int(qty)
-            raw_count += 1
-
-        # flush
-        rows = []
-        for _, rec in aggregated.items():
-            rows.append({
-                "item_key": rec["item_key"],
-                "name_base": rec["name_base"],
-                "stattrak": bool(rec["stattrak"]),
-                "souvenir": bool(rec["souvenir"]),
-                "condition": rec["condition"],
-                "price_whitemarket": float(rec["price_whitemarket"]),
-                "qty_whitemarket": int(rec["qty_whitemarket"]),
-                "fetched_at": rec["fetched_at"],
-            })
-        if rows:
-            upsert_market_rows(sb, rows)
-        print(f"[whitemarket] Finalizado: {len(rows)} itens únicos de {raw_count} lidos")
-        return len(rows)
-    except Exception as e:
-        print(f"[whitemarket] Erro crítico: {e}")
-        return 0
-
-
-if __name__ == "__main__":
-    count = run_whitemarket_ingest()
-    print(f"[whitemarket] itens agregados: {count}")
-
-import os
+import re
 import gzip
 import io
+import sys
+import queue
+import shutil
+import tempfile
+import threading
 import typing as t
+from dataclasses import dataclass
 from datetime import datetime, timezone
+from functools import lru_cache
 
+import orjson
 import requests
 from dotenv import load_dotenv
 import ijson
 
+from market_upsert import UPSERT_BATCH, drain_rows, get_rest_client, make_session, upsert_market_rows
+
 WHITEMARKET_URL = "https://s3.white.market/export/v1/products/730.json"
 WHITEMARKET_PRICES_CSV = "https://s3.white.market/export/v1/prices/730.csv"
 WHITEMARKET_PRICES_JSON = "https://s3.white.market/export/v1/prices/730.json"
+_SESSION = make_session()
 # Desabilita HTTP/2 no httpx/postgrest para evitar RemoteProtocolError em lotes grandes
 os.environ.setdefault("HTTPX_DISABLE_HTTP2", "1")
 # Carrega .env do diretório deste arquivo (robusto contra cwd diferente)
 ENV_PATH = os.path.join(os.path.dirname(__file__), ".env")
 load_dotenv(dotenv_path=ENV_PATH)
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE") or os.environ.get("SUPABASE_ANON_KEY")
 
-MARKET_TABLE = os.environ.get("SUPABASE_MARKET_TABLE", "market_data")
-UPSERT_BATCH = int(os.environ.get("SUPABASE_UPSERT_BATCH", "500"))
+# Itens únicos acumulados antes de um flush intermediário (teto de memória do agregado)
+FLUSH_ITEMS = int(os.environ.get("WHITEMARKET_FLUSH_ITEMS", str(max(50_000, UPSERT_BATCH * 10))))
+# Hosts com pouca memória: WHITEMARKET_STREAMING=1 lê o JSON de produtos só via ijson
+# (o ijson já usa o backend C yajl2_c quando disponível)
+WHITEMARKET_STREAMING = os.environ.get("WHITEMARKET_STREAMING") == "1"
+# Cópia local do JSON para as tentativas de root/NDJSON: acima disso vai para disco
+# (com WHITEMARKET_STREAMING=1 a cópia já vai direto para disco)
+SPOOL_MAX_BYTES = int(os.environ.get("WHITEMARKET_SPOOL_MAX_BYTES", str(64 * 1024 * 1024)))
 
 CONDITION_NAMES = [
     "Factory New",
@@ -220,33 +59,50 @@ CONDITION_NAMES = [
     "Battle-Scarred",
 ]
 
+# "(Condition)" suffix -> canonical (interned) condition string
+_CONDITION_BY_NAME = {cond: sys.intern(cond) for cond in CONDITION_NAMES}
+_PREFIX_RE = re.compile(r"StatTrak™ |StatTrak |Souvenir ")
+
 
+# O JSON de produtos traz um registro por anúncio: o mesmo nome se repete muitas vezes
+@lru_cache(maxsize=200_000)
 def parse_market_hash_name(name: str) -> t.Tuple[str, bool, bool, t.Optional[str]]:
     if not name:
         return "", False, False, None
     s = name
-    stattrak = "StatTrak" in s or "StatTrak™" in s
+    stattrak = "StatTrak" in s
     souvenir = "Souvenir" in s
     condition = None
-    for cond in CONDITION_NAMES:
-        if s.endswith(f"({cond})"):
-            condition = cond
-            s = s[: -(len(cond) + 2)].strip()
-            break
-    base = s.replace("StatTrak™ ", "").replace("StatTrak ", "").replace("Souvenir ", "").strip()
-    return base, stattrak, souvenir, condition
-
-
+    # One rfind + dict lookup instead of an endswith (and an f-string) per condition
+    if s[-1:] == ")":
+        i = s.rfind("(")
+        if i >= 0:
+            condition = _CONDITION_BY_NAME.get(s[i + 1:-1])
+            if condition is not None:
+                s = s[:i]
+    if stattrak or souvenir:
+        # Only tagged names (the minority) pay for the regex.
+        # Not anchored: knives carry the tag after the star ("★ StatTrak™ ...")
+        s = _PREFIX_RE.sub("", s)
+    # Interned: the five wear variants (and StatTrak/Souvenir ones) share one name_base object
+    return sys.intern(s.strip()), stattrak, souvenir, condition
+
+
+# Same reasoning as parse_market_hash_name: repeated listings rebuild the same key
+@lru_cache(maxsize=200_000)
 def build_item_key(name_base: str, stattrak: bool, souvenir: bool, condition: t.Optional[str], phase: t.Optional[str]) -> str:
-    parts = [
-        name_base or "",
-        ("StatTrak" if stattrak else ""),
-        ("Souvenir" if souvenir else ""),
-        condition or "",
-        phase or "",
-    ]
-    # keep a technical key without special symbols; join with pipe and collapse empties
-    return "|".join([p for p in parts if p != ""]).strip()
+    # keep a technical key without special symbols; join with pipe and collapse empties.
+    # Plain concatenation: no temporary list + filter per row
+    key = name_base or ""
+    if stattrak:
+        key += "|StatTrak"
+    if souvenir:
+        key += "|Souvenir"
+    if condition:
+        key += "|" + condition
+    if phase:
+        key += "|" + phase
+    return key.lstrip("|").strip()
 
 
 def build_display_name(name_base: str, stattrak: bool, souvenir: bool, condition: t.Optional[str], phase: t.Optional[str]) -> str:
@@ -267,17 +123,84 @@ def build_display_name(name_base: str, stattrak: bool, souvenir: bool, condition
     return name
 
 
-class PrependStream:
-    def __init__(self, head: bytes, base):
-        self.buf = io.BytesIO(head)
+class TeeStream:
+    """Repassa as leituras de `base` e grava uma cópia em `sink` (para reler sem novo download)."""
+
+    def __init__(self, base, sink):
         self.base = base
+        self.sink = sink
 
     def read(self, n: int = -1):
-        b = self.buf.read(n)
-        if n == -1 or len(b) == n:
-            return b
-        rest = self.base.read(n - len(b))
-        return b + rest
+        b = self.base.read(n)
+        self.sink.write(b)
+        return b
+
+
+class QueueStream(io.RawIOBase):
+    """Arquivo somente-leitura alimentado por uma thread de download (None = fim)."""
+
+    def __init__(self, chunks: "queue.Queue", stop: threading.Event, resp=None):
+        self.chunks = chunks
+        self.stop = stop
+        self.resp = resp
+        self.view = memoryview(b"")
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b) -> int:
+        while not self.view and not self.done:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.done = True
+            elif isinstance(chunk, BaseException):
+                raise chunk
+            else:
+                self.view = memoryview(chunk)
+        n = min(len(b), len(self.view))
+        b[:n] = self.view[:n]
+        self.view = self.view[n:]
+        return n
+
+    def close(self):
+        # Consumidor parou (fim, erro ou gerador fechado): libera a thread e o socket
+        if not self.closed:
+            self.stop.set()
+            if self.resp is not None:
+                self.resp.close()
+            self.view = memoryview(b"")
+        super().close()
+
+
+def download_in_background(resp, chunk_size: int = 1 << 20, max_chunks: int = 16) -> QueueStream:
+    """Baixa o corpo numa thread enquanto o chamador já consome (rede e parse em paralelo)."""
+    chunks: "queue.Queue" = queue.Queue(maxsize=max_chunks)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # put() com timeout para não travar na fila cheia se o consumidor desistiu
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def pump():
+        try:
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                if chunk and not put(chunk):
+                    break
+        except BaseException as e:
+            put(e)
+        finally:
+            put(None)
+            resp.close()
+
+    threading.Thread(target=pump, name="whitemarket-download", daemon=True).start()
+    return QueueStream(chunks, stop, resp)
 
 
 def open_source_stream(url: str, retry_count: int = 3):
@@ -293,29 +216,27 @@ def open_source_stream(url: str, retry_count: int = 3):
             if api_token:
                 headers["Authorization"] = f"Bearer {api_token}"
             
-            # Primeiro fazer HEAD request para verificar se a API está respondendo
-            head_resp = requests.head(url, headers=headers, timeout=30)
-            print(f"[whitemarket] HEAD response: {head_resp.status_code}")
-            
-            if head_resp.status_code == 404:
-                print(f"[whitemarket] API endpoint não encontrado: 404")
-                raise requests.exceptions.HTTPError("API endpoint não encontrado")
-            
-            # Fazer o request real
-            resp = requests.get(url, headers=headers, stream=True, timeout=120)  # Timeout maior
+            # Sem HEAD de verificação: o status do próprio GET já acusa 404 antes de ler o corpo
+            resp = _SESSION.get(url, headers=headers, stream=True, timeout=120)  # Timeout maior
+            if resp.status_code >= 400:
+                # Devolve a conexão ao pool da sessão (o corpo de erro nunca é lido)
+                resp.close()
+                if resp.status_code == 404:
+                    print(f"[whitemarket] API endpoint não encontrado: 404")
             resp.raise_for_status()
+            # urllib3 decodes Content-Encoding in C; the 1 MiB buffer amortizes ijson's small reads
             resp.raw.decode_content = True
+            # urllib3 fecha a resposta no EOF e o BufferedReader levantaria em vez de devolver b""
+            resp.raw.auto_close = False
+            stream = io.BufferedReader(resp.raw, buffer_size=1 << 20)
             
-            # Ler os primeiros bytes para verificar formato
-            head = resp.raw.read(4)
-            base = PrependStream(head, resp.raw)
-            
-            if head.startswith(b"\x1f\x8b"):
+            # .gz servido sem Content-Encoding: peek (sem cópia) dos bytes mágicos
+            if stream.peek(2)[:2] == b"\x1f\x8b":
                 print(f"[whitemarket] Arquivo GZIP detectado")
-                return gzip.GzipFile(fileobj=base, mode="rb")
+                return io.BufferedReader(gzip.GzipFile(fileobj=stream, mode="rb"), buffer_size=1 << 20)
             
             print(f"[whitemarket] Stream aberto com sucesso")
-            return base
+            return stream
             
         except requests.exceptions.Timeout:
             print(f"[whitemarket] Timeout na tentativa {attempt + 1}")
@@ -325,7 +246,9 @@ def open_source_stream(url: str, retry_count: int = 3):
             
         except requests.exceptions.HTTPError as e:
             print(f"[whitemarket] Erro HTTP na tentativa {attempt + 1}: {e}")
-            if attempt == retry_count - 1:
+            # 404 não muda entre tentativas: falha já, sem os GETs e esperas extras
+            not_found = e.response is not None and e.response.status_code == 404
+            if not_found or attempt == retry_count - 1:
                 raise
             time.sleep(5)
             
@@ -338,29 +261,6 @@ def open_source_stream(url: str, retry_count: int = 3):
     raise RuntimeError(f"Falha após {retry_count} tentativas")
 
 
-def get_supabase_client():
-    from supabase import create_client
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        raise RuntimeError("SUPABASE_URL/SUPABASE_SERVICE_ROLE não configurados no ambiente")
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
-
-
-def chunked(iterable, size: int):
-    buf = []
-    for x in iterable:
-        buf.append(x)
-        if len(buf) >= size:
-            yield buf
-            buf = []
-    if buf:
-        yield buf
-
-
-def upsert_market_rows(sb, rows: list[dict]):
-    for batch in chunked(rows, UPSERT_BATCH):
-        sb.table(MARKET_TABLE).upsert(batch, on_conflict="item_key").execute()
-
-
 def insert_price_snapshot(*args, **kwargs):
     # no-op kept for compatibility if referenced elsewhere
     return None
@@ -385,68 +285,74 @@ def iter_json_items(stream) -> t.Iterable[dict]:
     
 def fetch_whitemarket(url: str = WHITEMARKET_URL) -> t.Iterable[dict]:
     """Fetch WhiteMarket data with enhanced error handling"""
-    import json
+    raw = None
     
     # Método 1: Carregamento direto (mais confiável para JSON grandes)
-    try:
-        print(f"[whitemarket] Tentando carregamento direto de {url}")
+    # WHITEMARKET_STREAMING=1 pula direto para o parse incremental (menor pico de memória)
+    if not WHITEMARKET_STREAMING:
+        try:
+            print(f"[whitemarket] Tentando carregamento direto de {url}")
         
-        headers = {"Accept": "application/json"}
-        api_token = os.environ.get("WHITEMARKET_API_TOKEN")
-        if api_token:
-            headers["Authorization"] = f"Bearer {api_token}"
+            headers = {"Accept": "application/json"}
+            api_token = os.environ.get("WHITEMARKET_API_TOKEN")
+            if api_token:
+                headers["Authorization"] = f"Bearer {api_token}"
         
-        resp = requests.get(url, headers=headers, timeout=180)
-        resp.raise_for_status()
+            resp = _SESSION.get(url, headers=headers, timeout=180)
+            resp.raise_for_status()
         
-        print(f"[whitemarket] Response recebido: {len(resp.content)} bytes")
+            raw = resp.content
+            print(f"[whitemarket] Response recebido: {len(raw)} bytes")
         
-        # Descomprimir se necessário
-        if resp.content.startswith(b"\x1f\x8b"):
-            content = gzip.decompress(resp.content).decode('utf-8')
-            print(f"[whitemarket] GZIP descomprimido: {len(content)} chars")
-        else:
-            content = resp.text
-            print(f"[whitemarket] Texto direto: {len(content)} chars")
+            # Descomprimir se necessário
+            if raw[:2] == b"\x1f\x8b":
+                raw = gzip.decompress(raw)
+                print(f"[whitemarket] GZIP descomprimido: {len(raw)} bytes")
         
-        if not content.strip():
-            print(f"[whitemarket] ERRO: Conteúdo vazio")
-            raise ValueError("Conteúdo vazio")
+            raw = raw.strip()
+            if not raw:
+                print(f"[whitemarket] ERRO: Conteúdo vazio")
+                raise ValueError("Conteúdo vazio")
         
-        # Verificar integridade do JSON
-        content = content.strip()
-        if not (content.endswith('}') or content.endswith(']')):
-            print(f"[whitemarket] AVISO: JSON incompleto, últimos chars: {content[-50:]}")
+            # Verificar integridade do JSON
+            if not (raw.endswith(b'}') or raw.endswith(b']')):
+                print(f"[whitemarket] AVISO: JSON incompleto, últimos bytes: {raw[-50:]!r}")
         
-        data = json.loads(content)
-        print(f"[whitemarket] JSON válido: {type(data).__name__}")
+            # orjson lê os bytes direto: sem decode para str nem cópia do texto
+            data = orjson.loads(raw)
+            print(f"[whitemarket] JSON válido: {type(data).__name__}")
         
-        # Processar estruturas conhecidas
-        if isinstance(data, list):
-            print(f"[whitemarket] Array direto: {len(data)} itens")
-            for item in data:
-                if isinstance(item, dict):
-                    yield item
-        elif isinstance(data, dict):
-            for key in ['products', 'data', 'items', 'result']:
-                if key in data and isinstance(data[key], list):
-                    print(f"[whitemarket] Array em '{key}': {len(data[key])} itens")
-                    for item in data[key]:
-                        if isinstance(item, dict):
-                            yield item
-                    return
+            # Processar estruturas conhecidas
+            if isinstance(data, list):
+                print(f"[whitemarket] Array direto: {len(data)} itens")
+                for item in data:
+                    if isinstance(item, dict):
+                        yield item
+            elif isinstance(data, dict):
+                for key in ['products', 'data', 'items', 'result']:
+                    items = data.get(key)
+                    if isinstance(items, list):
+                        print(f"[whitemarket] Array em '{key}': {len(items)} itens")
+                        for item in items:
+                            if isinstance(item, dict):
+                                yield item
+                        return
             
-            if 'market_hash_name' in data:
-                yield data
+                if 'market_hash_name' in data:
+                    yield data
         
-        return
+            return
         
-    except (json.JSONDecodeError, ValueError) as e:
-        print(f"[whitemarket] Erro JSON: {e}. Tentando streaming...")
-    except Exception as e:
-        print(f"[whitemarket] Erro direto: {e}. Tentando streaming...")
+        except ValueError as e:
+            # orjson.JSONDecodeError é subclasse de ValueError
+            print(f"[whitemarket] Erro JSON: {e}. Tentando streaming...")
+        except Exception as e:
+            print(f"[whitemarket] Erro direto: {e}. Tentando streaming...")
     
     # Método 2: Streaming (fallback)
+    # Um único download para todas as tentativas: a primeira lê da rede copiando para um
+    # spool e as demais (e o NDJSON) relêem o spool. Se o Método 1 já baixou o corpo, nem isso.
+    spool = io.BytesIO(raw) if raw else None
     root_paths = [
         "item",
         "products.item", 
@@ -454,12 +360,25 @@ def fetch_whitemarket(url: str = WHITEMARKET_URL) -> t.Iterable[dict]:
     ]
 
     for root in root_paths:
+        tee = None
         try:
             print(f"[whitemarket] Streaming com root: {root}")
-            stream = open_source_stream(url)
+            if spool is None:
+                source = open_source_stream(url)
+                # WHITEMARKET_STREAMING promete pico de ~1 item: a cópia vai direto para disco
+                # (max_size=0 num SpooledTemporaryFile significaria nunca sair da RAM)
+                if WHITEMARKET_STREAMING:
+                    spool = tempfile.TemporaryFile()
+                else:
+                    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+                stream = tee = TeeStream(source, spool)
+            else:
+                spool.seek(0)
+                stream = spool
             got_any = False
             
-            for obj in ijson.items(stream, root):
+            # use_float: números viram float/int (não Decimal), como o caminho orjson entrega
+            for obj in ijson.items(stream, root, use_float=True):
                 got_any = True
                 if isinstance(obj, dict):
                     yield obj
@@ -470,275 +389,274 @@ def fetch_whitemarket(url: str = WHITEMARKET_URL) -> t.Iterable[dict]:
                 
         except ijson.common.IncompleteJSONError as e:
             print(f"[whitemarket] JSON incompleto com {root}: {e}")
-            continue
         except Exception as e:
             print(f"[whitemarket] Erro streaming {root}: {e}")
-            continue
 
-    # Fallback: NDJSON (one JSON object per line)
-    stream = open_source_stream(url)
-    text_stream = io.TextIOWrapper(stream, encoding='utf-8', errors='ignore')
-    for line in text_stream:
+        if tee is not None:
+            # Completa o spool com o que o parser não chegou a ler
+            try:
+                shutil.copyfileobj(tee.base, spool, 1 << 20)
+            except Exception as e:
+                print(f"[whitemarket] Download incompleto ({e}); a próxima tentativa baixa de novo")
+                spool = None
+
+    # Fallback: NDJSON (one JSON object per line), reusing the bytes already downloaded
+    if spool is not None:
+        spool.seek(0)
+        lines = spool
+    else:
+        lines = open_source_stream(url)
+    for line in lines:
         try:
-            obj = json.loads(line)
-            if isinstance(obj, dict):
-                yield obj
-        except Exception:
+            obj = orjson.loads(line)
+        except orjson.JSONDecodeError:
             continue
+        if isinstance(obj, dict):
+            yield obj
+
+
+def iter_prices_csv(url: str = WHITEMARKET_PRICES_CSV) -> t.Iterable[t.Tuple[str, str, str]]:
+    """Itera o CSV leve de preços do WhiteMarket como tuplas (market_hash_name, price, market_product_count)."""
+    import csv
+    headers = {"Accept": "text/csv"}
+    api_token = os.environ.get("WHITEMARKET_API_TOKEN")
+    if api_token:
+        headers["Authorization"] = f"Bearer {api_token}"
+    resp = _SESSION.get(url, headers=headers, stream=True, timeout=180)
+    if resp.status_code >= 400:
+        # Devolve a conexão ao pool da sessão (o corpo de erro nunca é lido)
+        resp.close()
+    resp.raise_for_status()
+    # O download segue numa thread (blocos de 1 MiB) enquanto este gerador já faz o parse
+    source = download_in_background(resp)
+    try:
+        stream = io.BufferedReader(source, buffer_size=1 << 20)
+        if stream.peek(2)[:2] == b"\x1f\x8b":
+            stream = gzip.GzipFile(fileobj=stream, mode="rb")
+        # csv.reader devolve listas, sem um dict por linha
+        reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8", errors="ignore", newline=""))
+        header = next(reader, None)
+        if not header:
+            return
+        # Resolve as colunas uma vez; a ordem do export pode mudar
+        cols = [c.strip() for c in header]
+        i_name = cols.index("market_hash_name")
+        i_price = cols.index("price")
+        i_qty = cols.index("market_product_count") if "market_product_count" in cols else None
+        width = max(i_name, i_price, i_qty or 0) + 1
+        for row in reader:
+            if len(row) < width:
+                continue
+            yield row[i_name], row[i_price], (row[i_qty] if i_qty is not None else "")
+    finally:
+        # GzipFile não fecha o fileobj: fecha a fonte direto para parar a thread de download
+        source.close()
 
 
-def aggregate_whitemarket(products: t.Iterable[dict]) -> t.Dict[str, dict]:
-    """Agrega diretamente por item normalizado (name_base/st/sv/condition) e usa SEMPRE o menor preço.
+def iter_csv_prices(rows: t.Iterable[t.Tuple[str, str, str]]) -> t.Iterator[t.Tuple[str, float, int]]:
+    """Converte as linhas do CSV em (name, price, qty) num laço enxuto; descarta as sem nome/preço."""
+    for name, price_str, qty_str in rows:
+        if not name:
+            continue
+        # float()/int() já ignoram espaços; só aloca uma cópia quando há vírgula decimal
+        if "," in price_str:
+            price_str = price_str.replace(",", ".")
+        try:
+            price = float(price_str)
+        except ValueError:
+            continue
+        try:
+            qty = int(qty_str)
+        except ValueError:
+            # vazio ou não numérico
+            qty = 0
+        yield name, price, qty
 
-    Evita agrupar por product_class_id para não mesclar variantes diferentes acidentalmente.
-    """
-    def to_usd(val, field_name: str):
-        v = val
-        if isinstance(v, str):
-            try:
-                v = float(v.replace(",", ".").strip())
-            except Exception:
-                return None
-        # heurística: campos *_cents são centavos
-        if field_name.endswith("_cents") and isinstance(v, (int, float)):
-            return float(v) / 100.0
-        # heurística adicional: inteiros muito grandes podem ser centavos
-        if isinstance(v, int) and v >= 1000:
-            return float(v) / 100.0
+
+def _to_usd(val, field_name: str):
+    v = val
+    if isinstance(v, str):
         try:
-            return float(v)
+            v = float(v.replace(",", ".").strip())
         except Exception:
             return None
+    if field_name.endswith("_cents") and isinstance(v, (int, float)):
+        return float(v) / 100.0
+    if isinstance(v, int) and v >= 1000:
+        return float(v) / 100.0
+    try:
+        return float(v)
+    except Exception:
+        return None
+
+
+def _normalize_price(p: dict) -> t.Optional[float]:
+    # tenta múltiplos campos comuns e retorna o menor valor válido
+    candidates = []
+    for f in ("price_usd", "price_cents", "price", "amount", "value"):
+        v = p.get(f)
+        if v is not None:
+            usd = _to_usd(v, f)
+            if usd is not None and usd > 0:
+                candidates.append(usd)
+    if not candidates:
+        return None
+    return min(candidates)
+
+
+def iter_product_prices(products: t.Iterable[dict]) -> t.Iterator[t.Tuple[str, float, int]]:
+    """Mesma saída de iter_csv_prices a partir do JSON de produtos (um registro por anúncio)."""
+    for product in products:
+        if not product:
+            continue
+        try:
+            name = (
+                product.get("name_hash")
+                or product.get("market_hash_name")
+                or product.get("hash_name")
+                or product.get("name")
+                or ""
+            )
+            price = _normalize_price(product)
+            qty = product.get("qty") or 1
+            # orjson/ijson(use_float) já entregam int: só converte o que vier como texto/float
+            if type(qty) is not int:
+                qty = int(qty)
+        except Exception as e:
+            print(f"[whitemarket] Erro ao processar item: {e}")
+            continue
+        # str garantido aqui: o agregador não precisa de str() por linha
+        if not name or not isinstance(name, str) or price is None:
+            continue
+        yield name, price, qty
+
+
+@dataclass(slots=True)
+class WhitemarketRec:
+    """Registro agregado por item_key (com slots, bem menor que um dict por item)."""
+    item_key: str
+    name_base: str
+    stattrak: bool
+    souvenir: bool
+    condition: t.Optional[str]
+    price_whitemarket: float
+    qty_whitemarket: int
+    fetched_at: str
+
+    def to_row(self) -> dict:
+        return {
+            "item_key": self.item_key,
+            "name_base": self.name_base,
+            "stattrak": self.stattrak,
+            "souvenir": self.souvenir,
+            "condition": self.condition,
+            "price_whitemarket": self.price_whitemarket,
+            "qty_whitemarket": self.qty_whitemarket,
+            "fetched_at": self.fetched_at,
+        }
+
+
+def aggregate_whitemarket(
+    prices: t.Iterable[t.Tuple[str, float, int]], flush_size: int = FLUSH_ITEMS
+) -> t.Iterator[t.Dict[str, WhitemarketRec]]:
+    """Agrega diretamente por item normalizado (name_base/st/sv/condition): MENOR preço, qty somada.
+
+    Recebe as tuplas de iter_csv_prices/iter_product_prices (mesma conversão de preço para as
+    duas fontes) e entrega o agregado a cada flush_size itens únicos e no fim.
+    Evita agrupar por product_class_id para não mesclar variantes diferentes acidentalmente.
+    """
+    # Todos os registros da execução compartilham o mesmo timestamp: formata uma vez
+    now_iso = datetime.now(timezone.utc).isoformat()
+    acc: t.Dict[str, WhitemarketRec] = {}
+    # Loop quente: helpers em variáveis locais evitam lookup global por linha
+    parse_name = parse_market_hash_name
+    key_of = build_item_key
+    for name, price, qty in prices:
+        try:
+            name_base, stattrak, souvenir, condition = parse_name(name)
+            if not name_base:
+                continue
+            item_key = key_of(name_base, stattrak, souvenir, condition, None)
+        except Exception as e:
+            print(f"[whitemarket] Erro ao processar item: {e}")
+            continue
 
-    acc: t.Dict[str, dict] = {}
-    now = datetime.now(timezone.utc)
-    for p in products:
-        name = (
-            p.get("name_hash")
-            or p.get("market_hash_name")
-            or p.get("hash_name")
-            or p.get("name")
-            or ""
-        )
-        # preço desta linha
-        line_price = None
-        for f in ("price", "price_usd", "price_cents", "amount", "value"):
-            if f in p and p[f] is not None:
-                line_price = to_usd(p[f], f)
-                if line_price is not None:
-                    break
-
-        # normalização do item
-        name_base, stattrak, souvenir, condition = parse_market_hash_name(str(name))
-        item_key = build_item_key(name_base, stattrak, souvenir, condition, None)
-
+        # um único lookup por linha
         rec = acc.get(item_key)
-        if not rec:
-            acc[item_key] = rec = {
-                "item_key": item_key,
-                "name_base": name_base,
-                "stattrak": stattrak,
-                "souvenir": souvenir,
-                "condition": condition,
-                "price_whitemarket": line_price,
-                "qty_whitemarket": 1,
-                "fetched_at": now,
-            }
-        else:
-            rec["qty_whitemarket"] = int(rec.get("qty_whitemarket", 0)) + 1
-            if line_price is not None:
-                cur = rec.get("price_whitemarket")
-                if cur is None or line_price < cur:
-                    rec["price_whitemarket"] = line_price
-    return acc
-
+        if rec is None:
+            acc[item_key] = WhitemarketRec(item_key, name_base, stattrak, souvenir, condition, price, qty, now_iso)
+            # CRÍTICO: Limitar tamanho do dict agregado
+            if len(acc) >= flush_size:
+                yield acc
+                acc = {}
+            continue
+        # Sempre manter o MENOR preço encontrado para a variante
+        # (price/qty já chegam como float/int: sem casts nem try aqui)
+        if price < rec.price_whitemarket:
+            rec.price_whitemarket = price
+        rec.qty_whitemarket += qty
+    if acc:
+        yield acc
 
-def iter_prices_csv(url: str = WHITEMARKET_PRICES_CSV) -> t.Iterable[dict]:
-    """Itera o CSV leve de preços do WhiteMarket (menor preço e contagem por item)."""
-    import csv
-    headers = {"Accept": "text/csv"}
-    api_token = os.environ.get("WHITEMARKET_API_TOKEN")
-    if api_token:
-        headers["Authorization"] = f"Bearer {api_token}"
-    with requests.get(url, headers=headers, stream=True, timeout=180) as resp:
-        resp.raise_for_status()
-        text_stream = io.TextIOWrapper(resp.raw, encoding='utf-8', errors='ignore')
-        reader = csv.DictReader(text_stream)
-        for row in reader:
-            yield {
-                "market_hash_name": row.get("market_hash_name") or "",
-                "price": row.get("price"),
-                "market_product_count": row.get("market_product_count"),
-            }
 
+def run_whitemarket_ingest(url: str = WHITEMARKET_URL, prefer_csv: bool = True, pause_gc: bool = True) -> int:
+    """Executa ingestão otimizada para economia de memória.
 
-def run_whitemarket_ingest(url: str = WHITEMARKET_URL, prefer_csv: bool = True) -> int:
-    """Executa ingestão otimizada para economia de memória"""
+    pause_gc=False mantém o coletor ligado: gc.disable() vale para o processo inteiro,
+    então não deve ser usado com outras ingestões rodando em paralelo.
+    """
     import gc
     
-    sb = get_supabase_client()
-    batch_size = int(os.environ.get('SUPABASE_UPSERT_BATCH', '200'))
+    client = get_rest_client()
+    flush_size = FLUSH_ITEMS
+    flushes = 0
     total_processed = 0
     
-    print(f"[whitemarket] Iniciando com batch_size={batch_size}")
+    print(f"[whitemarket] Iniciando com batch_size={UPSERT_BATCH}, flush a cada {flush_size} itens")
     
     try:
         # Escolhe fonte (CSV rápido por padrão)
         if prefer_csv:
             print(f"[whitemarket] Preferindo CSV: {WHITEMARKET_PRICES_CSV}")
-            products = iter_prices_csv(WHITEMARKET_PRICES_CSV)
+            prices = iter_csv_prices(iter_prices_csv(WHITEMARKET_PRICES_CSV))
         else:
             print(f"[whitemarket] Usando JSON de produtos: {url}")
-            products = fetch_whitemarket(url)
-        aggregated = {}
-        raw_count = 0
-        
-        def _to_usd(val, field_name: str):
-            v = val
-            if isinstance(v, str):
+            prices = iter_product_prices(fetch_whitemarket(url))
+
+        # Parse + agregação só criam objetos sem ciclos (tuplas, strings, registros com slots):
+        # o coletor geracional dispararia centenas de vezes sem liberar nada
+        gc_was_enabled = gc.isenabled()
+        pause = pause_gc and gc_was_enabled
+        if pause:
+            gc.disable()
+        try:
+            for aggregated in aggregate_whitemarket(prices, flush_size):
+                # O upsert (httpx, thread pool) não entra na janela sem GC: religa só durante o flush
+                if pause:
+                    gc.enable()
                 try:
-                    v = float(v.replace(",", ".").strip())
-                except Exception:
-                    return None
-            if field_name.endswith("_cents") and isinstance(v, (int, float)):
-                return float(v) / 100.0
-            if isinstance(v, int) and v >= 1000:
-                return float(v) / 100.0
-            try:
-                return float(v)
-            except Exception:
-                return None
-
-        def _normalize_price(p: dict) -> t.Optional[float]:
-            # tenta múltiplos campos comuns e retorna o menor valor válido
-            candidates = []
-            for f in ("price_usd", "price_cents", "price", "amount", "value"):
-                if f in p and p[f] is not None:
-                    usd = _to_usd(p[f], f)
-                    if usd is not None and usd > 0:
-                        candidates.append(usd)
-            if not candidates:
-                return None
-            return min(candidates)
-
-        for product in products:
-            if not product:
-                continue
-                
-            try:
-                # Processar item individual
-                if prefer_csv:
-                    name = product.get("market_hash_name") or ""
-                    price_str = product.get("price")
-                    qty_str = product.get("market_product_count")
+                    # drain_rows esvazia o agregado; sem gc.collect() aqui: uma coleta
+                    # completa por flush só travava o loop
+                    sent = upsert_market_rows(client, drain_rows(aggregated, ordered=True))
+                    total_processed += sent
+                    flushes += 1
+                    print(f"[whitemarket] Flush {flushes}: {sent} itens únicos")
+
+                    # Log de memória a cada flush (agora raros)
                     try:
-                        price = float(str(price_str).replace(",", ".").strip()) if price_str is not None else None
-                    except Exception:
-                        price = None
-                    try:
-                        qty = int(qty_str) if qty_str is not None and str(qty_str).strip() != '' else 0
-                    except Exception:
-                        qty = 0
-                else:
-                    name = (
-                        product.get("name_hash")
-                        or product.get("market_hash_name")
-                        or product.get("hash_name")
-                        or product.get("name")
-                        or ""
-                    )
-                    price = _normalize_price(product)
-                    qty = int(product.get("qty", 1) or 1)
-                
-                if not name or not isinstance(price, (int, float)):
-                    continue
-                    
-                name_base, stattrak, souvenir, condition = parse_market_hash_name(str(name))
-                if not name_base:
-                    continue
-                    
-                item_key = build_item_key(name_base, stattrak, souvenir, condition, None)
-                
-                # Agregar na memória temporária (limitada)
-                if item_key in aggregated:
-                    # Sempre manter o MENOR preço encontrado para a variante
-                    try:
-                        cur = float(aggregated[item_key]["price_whitemarket"])
-                    except Exception:
-                        cur = None
-                    if cur is None or price < cur:
-                        aggregated[item_key]["price_whitemarket"] = price
-                    aggregated[item_key]["qty_whitemarket"] = int(aggregated[item_key].get("qty_whitemarket", 0)) + qty
-                else:
-                    aggregated[item_key] = {
-                        "item_key": item_key,
-                        "name_base": name_base,
-                        "stattrak": stattrak,
-                        "souvenir": souvenir,
-                        "condition": condition,
-                        "price_whitemarket": price,
-                        "qty_whitemarket": qty,
-                        "fetched_at": datetime.now(timezone.utc),
-                    }
-                
-                raw_count += 1
-                
-                # CRÍTICO: Limitar tamanho do dict agregado
-                if len(aggregated) >= batch_size:
-                    rows = []
-                    for _, rec in aggregated.items():
-                        rows.append({
-                            "item_key": rec["item_key"],
-                            "name_base": rec["name_base"],
-                            "stattrak": bool(rec["stattrak"]),
-                            "souvenir": bool(rec["souvenir"]),
-                            "condition": rec["condition"],
-                            "price_whitemarket": rec["price_whitemarket"],
-                            "qty_whitemarket": int(rec["qty_whitemarket"]),
-                            "fetched_at": rec["fetched_at"].isoformat(),
-                        })
-                    
-                    if rows:
-                        upsert_market_rows(sb, rows)
-                        total_processed += len(rows)
-                        print(f"[whitemarket] Batch {total_processed//batch_size}: {len(rows)} itens únicos de {raw_count} processados")
-                    
-                    # Limpar memória agressivamente
-                    aggregated.clear()
-                    rows.clear()
-                    gc.collect()
-                    
-                    # Log de memória a cada batch
-                    if total_processed % (batch_size * 3) == 0:  # A cada 3 batches
-                        try:
-                            import memory_optimizer
-                            memory_optimizer.log_memory_usage(f"WhiteMarket batch {total_processed//batch_size}")
-                            memory_optimizer.memory_limit_check(350)  # Limite mais baixo durante processamento
-                        except:
-                            pass
-                    
-            except Exception as e:
-                print(f"[whitemarket] Erro ao processar item: {e}")
-                continue
-        
-        # Processar itens restantes
-        if aggregated:
-            rows = []
-            for _, rec in aggregated.items():
-                rows.append({
-                    "item_key": rec["item_key"],
-                    "name_base": rec["name_base"],
-                    "stattrak": bool(rec["stattrak"]),
-                    "souvenir": bool(rec["souvenir"]),
-                    "condition": rec["condition"],
-                    "price_whitemarket": rec["price_whitemarket"],
-                    "qty_whitemarket": int(rec["qty_whitemarket"]),
-                    "fetched_at": rec["fetched_at"].isoformat(),
-                })
-            
-            if rows:
-                upsert_market_rows(sb, rows)
-                total_processed += len(rows)
+                        import memory_optimizer
+                        memory_optimizer.log_memory_usage(f"WhiteMarket flush {flushes}")
+                        memory_optimizer.memory_limit_check(350)  # Limite mais baixo durante processamento
+                    except:
+                        pass
+                finally:
+                    if pause:
+                        gc.disable()
+        finally:
+            if pause:
+                gc.enable()
+        # Uma única coleta, depois do último flush
+        gc.collect()
         
         print(f"[whitemarket] Finalizado: {total_processed} itens total")
         return total_processed
@@ -746,6 +664,8 @@ def run_whitemarket_ingest(url: str = WHITEMARKET_URL, prefer_csv: bool = True)
     except Exception as e:
         print(f"[whitemarket] Erro crítico: {e}")
         return total_processed
+    finally:
+        client.close()
 
 
 if __name__ == "__main__":